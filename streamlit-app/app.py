@@ -1,10 +1,45 @@
 import streamlit as st
 from diagnostics import diagnose_pod
 from kubernetes import client, config
+from kubernetes.client import api_client as k8s_api_client
+from kubernetes.client.rest import ApiException
 from kubernetes.config.kube_config import list_kube_config_contexts
 from llm_groq import ask_groq_llm
+from collections.abc import Iterable
+import io
 import json
 import re
+import types
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Let the Kubernetes client decode API responses with orjson. Only the
+# client module's "json" name is rebound, the stdlib module is untouched.
+if orjson is not None:
+    _k8s_json = types.ModuleType("json")
+    _k8s_json.__dict__.update(json.__dict__)
+    _k8s_json.loads = orjson.loads
+    k8s_api_client.json = _k8s_json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# markupsafe (installed with Streamlit via jinja2) escapes in C; html otherwise
+try:
+    from markupsafe import escape
+except ImportError:
+    from html import escape
+
+# google-re2 matches in linear time (no backtracking); stdlib re otherwise
+try:
+    import re2 as regex
+except ImportError:
+    regex = re
 
 if "ai_chat" not in st.session_state:
     st.session_state.ai_chat = []
@@ -17,6 +52,64 @@ if "diagnosis_result" not in st.session_state:
 if "last_diagnosed_pod" not in st.session_state:
     st.session_state.last_diagnosed_pod = None
 
+if "messages" not in st.session_state:
+    st.session_state.messages = []
+
+# Rendered evidence markdown for the current diagnosis_result
+if "evidence_md" not in st.session_state:
+    st.session_state.evidence_md = None
+
+
+# Helper: Append to the chat history, validating on insert so the list
+# never needs to be scrubbed on render
+def append_message(role, content):
+    if content in (None, "None"):
+        return
+    st.session_state.messages.append({"role": role, "content": content})
+
+
+# JSON helpers: use orjson when installed, stdlib json otherwise
+def _json_loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _json_dumps_pretty(value):
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(value, indent=2)
+
+
+# Top-level keys of a Kubernetes Status body that the evidence view shows
+_STATUS_BODY_KEYS = frozenset({"status", "message", "reason", "details"})
+
+
+# Helper: Load only the displayed keys of an API error body; with ijson the
+# bulky subtrees are skipped instead of being built and thrown away
+def _load_status_body(json_part):
+    if ijson is None:
+        return _json_loads(json_part)
+
+    events = ijson.parse(io.BytesIO(json_part.encode()), use_float=True)
+    # Like the stdlib path, a body that is not an object is shown as full_body
+    if next(events)[1] != "start_map":
+        raise ValueError("API error body is not a JSON object")
+
+    builders = {}
+    for prefix, event, value in events:
+        key = prefix.partition(".")[0]
+        if key not in _STATUS_BODY_KEYS:
+            continue
+        if key not in builders:
+            builders[key] = ijson.ObjectBuilder()
+        builders[key].event(event, value)
+    return {key: builder.value for key, builder in builders.items()}
+
+
+# Status code and reason in an APIException string e.g. "(404) Reason: NotFound"
+_K8S_ERR_RE = regex.compile(r"\((\d+)\)\s+Reason:\s+([A-Za-z]+)")
+
 
 # Helper: Parse Kubernetes APIException into structured format
 def parse_k8s_api_error(error_string):
@@ -24,48 +117,164 @@ def parse_k8s_api_error(error_string):
     data = {}
 
     # Extract status code and reason e.g. "(404) Reason: NotFound"
-    m = re.search(r"\((\d+)\)\s+Reason:\s+([A-Za-z]+)", error_string)
+    m = _K8S_ERR_RE.search(error_string)
     if m:
         data["status_code"] = m.group(1)
         data["reason"] = m.group(2)
 
     # Extract JSON from "HTTP response body:" if present
-    if "HTTP response body:" in error_string:
+    _, sep, json_part = error_string.partition("HTTP response body:")
+    if sep:
+        json_part = json_part.strip()
         try:
-            json_part = error_string.split("HTTP response body:")[1].strip()
-            parsed_json = json.loads(json_part)
+            parsed_json = _load_status_body(json_part)
             data.update(parsed_json)
         except Exception:
-            data["full_body"] = json_part if 'json_part' in locals() else error_string
+            data["full_body"] = json_part
 
     return data
 
 
-# Helper: Create CoreV1Api object for a specific kubeconfig context
+# Backtick runs in text that is about to be fenced
+_BACKTICK_RUN_RE = regex.compile(r"`+")
+
+
+# Helper: Fenced code block for untrusted text (logs, events, API bodies).
+# The fence is longer than any backtick run inside, so the content cannot
+# close it early and render as markdown
+def _code_block(text, lang=""):
+    longest = max((len(run) for run in _BACKTICK_RUN_RE.findall(text)), default=0)
+    fence = "`" * max(3, longest + 1)
+    return f"{fence}{lang}\n{text}\n{fence}"
+
+
+# Helper: Build the "Evidence Details" markdown as a single string
+def _render_evidence(evidence):
+
+    if isinstance(evidence, str):
+        if "HTTP response body:" in evidence:
+            parts = ["### Kubernetes API Error"]
+            parsed = parse_k8s_api_error(evidence)
+
+            excluded_keys = {"kind", "apiVersion", "metadata", "code"}
+
+            for key, value in parsed.items():
+                if key in excluded_keys:
+                    continue
+                label = key.replace("_", " ").title()
+
+                if isinstance(value, dict):
+                    if value:
+                        parts.append(f"**{label}:**\n" + _code_block(_json_dumps_pretty(value), "json"))
+                else:
+                    parts.append(f"**{label}:** {value}")
+            return "\n\n".join(parts)
+
+        return "### Pod Description Analysis\n\n" + _code_block(evidence)
+
+    if isinstance(evidence, dict):
+        parts = []
+        for key, value in evidence.items():
+            if key == "last_logs":
+                continue
+            label = key.replace("_", " ").title()
+
+            if isinstance(value, Iterable) and not isinstance(value, str):
+                bullets = "\n".join(f"- {escape(str(item))}" for item in value)
+                parts.append(f"**{label}:**\n{bullets}")
+            else:
+                parts.append(f"**{label}:** {value}")
+        return "\n\n".join(parts)
+
+    # Lists of events, or the lazy log tails from diagnostics
+    if isinstance(evidence, Iterable):
+        lines = "\n".join(str(x) for x in evidence)
+        return "**Logs / Events:**\n\n" + _code_block(lines)
+
+    return "No evidence available."
+
+
+# Helper: Create CoreV1Api object for a specific kubeconfig context.
+# One client per context is kept, so reruns reuse its kubeconfig parse and
+# connection pool; failures raise and are therefore not cached. This has to
+# be st.cache_resource: the script is re-executed on every rerun, which
+# would discard a functools.lru_cache along with the function.
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _v1_for_context(context_name):
+    configuration = client.Configuration()
+    # At least room for the concurrent diagnosis reads plus the sidebar
+    # listings from several sessions sharing this client; the client's own
+    # default (cpu_count * 5) is already larger on most hosts
+    configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize, 10)
+    api_client = config.new_client_from_config(
+        context=context_name, client_configuration=configuration
+    )
+    return client.CoreV1Api(api_client)
+
+
 def make_v1_for_context(context_name):
     if not context_name:
         return None
     try:
-        api_client = config.new_client_from_config(context=context_name)
-        return client.CoreV1Api(api_client)
+        return _v1_for_context(context_name)
     except Exception as e:
         st.sidebar.error(f"Failed to load context '{context_name}': {e}")
         return None
 
 
 # Load kubeconfig contexts + pretty display names
+@st.cache_data(ttl=60, show_spinner=False)
 def get_contexts_and_display():
     try:
         contexts, active_context = list_kube_config_contexts()
-        ctx_items = []
-        for ctx in contexts:
-            name = ctx.get("name")
-            display = name.split("_")[-1] if "_" in name else name
-            ctx_items.append({"context_name": name, "display_name": display})
+        # display_name -> actual context name, e.g. "gke_proj_zone_dev" -> "dev"
+        display_to_context = {
+            (name.rpartition("_")[2] or name): name
+            for name in (ctx.get("name") for ctx in contexts)
+        }
         active_name = active_context.get("name") if active_context else None
-        return ctx_items, active_name
+        return tuple(display_to_context), display_to_context, active_name
     except Exception:
-        return [], None
+        return (), {}, None
+
+
+# Namespace and pod listings are cached per context name (hashable) instead
+# of the CoreV1Api object
+@st.cache_data(ttl=15, show_spinner=False)
+def _get_namespaces(context_name):
+    v1api = _v1_for_context(context_name)
+    try:
+        nss = v1api.list_namespace().items
+    except ApiException as e:
+        if e.status != 403:
+            raise
+        # RBAC may forbid listing namespaces; derive them from the pods instead
+        pods = v1api.list_pod_for_all_namespaces().items
+        return sorted({p.metadata.namespace for p in pods if p.metadata and p.metadata.namespace})
+    return sorted(ns.metadata.name for ns in nss if ns.metadata and ns.metadata.name)
+
+
+@st.cache_data(ttl=15, show_spinner=False)
+def _get_pods(context_name, ns):
+    v1api = _v1_for_context(context_name)
+    # Page through large namespaces instead of pulling every pod in one response
+    names = []
+    token = None
+    while True:
+        resp = v1api.list_namespaced_pod(ns, limit=500, _continue=token)
+        names.extend(p.metadata.name for p in resp.items if p.metadata and p.metadata.name)
+        token = resp.metadata._continue if resp.metadata else None
+        if not token:
+            return names
+
+
+# Helper: Drop every cached cluster lookup, so kubeconfig edits, rotated
+# credentials and new namespaces / pods show up right away
+def clear_cluster_caches():
+    get_contexts_and_display.clear()
+    _v1_for_context.clear()
+    _get_namespaces.clear()
+    _get_pods.clear()
 
 
 # Dark theme CSS
@@ -87,6 +296,30 @@ h1, h2, h3, p, label { color: #E5E7EB !important; }
 st.markdown(DARK_THEME, unsafe_allow_html=True)
 
 
+# Diagnosis card templates; values are HTML-escaped before formatting since
+# they can carry pod names and Kubernetes error text
+_SUMMARY_TPL = """
+<div class="card">
+    <h3>Summary</h3>
+    <p>{}</p>
+</div>
+"""
+
+_CAUSE_TPL = """
+<div class="card">
+    <h3>Likely Cause</h3>
+    <p>{}</p>
+</div>
+"""
+
+_RECOMMENDATION_TPL = """
+<div class="card" style="background-color:#1E3A8A; border-color:#3B82F6; color:#F3F4F6;">
+    <h3 style="color:#fff;">Recommendation</h3>
+    <p style="color:#E0E7FF;">{}</p>
+</div>
+"""
+
+
 # Page header
 st.markdown("""
 <div style="text-align: center; padding-top: 10px; padding-bottom: 18px;">
@@ -120,20 +353,28 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+# Placeholder values meaning "nothing selected" for the namespace / pod inputs
+_NS_SENTINELS = frozenset({"-- Select a Namespace --", "-- Select --", "", None})
+_POD_SENTINELS = frozenset({"-- Select a Pod --", "-- Select --", "", None})
+
+
 # Sidebar UI: Cluster -> Namespace -> Pod
 st.sidebar.title("⚙️ Cluster Settings")
 
-contexts_info, active_context_name = get_contexts_and_display()
+# Contexts, clients and listings are cached; allow picking up changes now
+if st.sidebar.button("🔄 Refresh contexts"):
+    clear_cluster_caches()
+    st.session_state.last_pod_key = None
 
-if not contexts_info:
-    st.sidebar.error("No kubeconfig contexts found. Ensure kubeconfig exists.")
-    contexts_info = [{"context_name": None, "display_name": "-- No Contexts Found --"}]
+context_display_names, display_to_context, active_context_name = get_contexts_and_display()
 
-# Map display_name -> actual context name
-display_to_context = {c["display_name"]: c["context_name"] for c in contexts_info}
+if not display_to_context:
+    st.sidebar.error("No kubeconfig contexts found. Ensure kubeconfig exists.")
+    context_display_names = ("-- No Contexts Found --",)
+    display_to_context = {"-- No Contexts Found --": None}
 
 # Dropdown display list
-display_names = ["-- Select a Cluster --"] + [c["display_name"] for c in contexts_info]
+display_names = ("-- Select a Cluster --",) + context_display_names
 
 selected_cluster_display = st.sidebar.selectbox("☸️ Cluster", display_names, index=0)
 st.sidebar.caption("Choose which Kubernetes cluster to connect to")
@@ -156,17 +397,16 @@ if selected_context != st.session_state.last_cluster:
 
 
 # Namespace handling
-def get_namespaces(v1api):
-    if not v1api:
+def get_namespaces(context_name):
+    if not context_name:
         return []
     try:
-        pods = v1api.list_pod_for_all_namespaces().items
-        return sorted({p.metadata.namespace for p in pods if p.metadata and p.metadata.namespace})
+        return _get_namespaces(context_name)
     except Exception as e:
         st.sidebar.error(f"Failed to list namespaces: {e}")
         return []
 
-namespace_list = get_namespaces(v1_for_selected)
+namespace_list = get_namespaces(selected_context)
 namespace_options = ["-- Select a Namespace --"] + namespace_list
 namespace = st.sidebar.selectbox("📂 Namespace", namespace_options, index=0)
 st.sidebar.caption("Select the namespace where the workload exists")
@@ -183,17 +423,29 @@ if namespace != st.session_state.last_namespace:
 
 
 # Pod handling
-def get_pods(v1api, ns):
-    if not v1api or ns in ("-- Select a Namespace --", None, ""):
+# Returns None when listing failed, so the caller knows to retry
+def get_pods(context_name, ns):
+    if not context_name or ns in _NS_SENTINELS:
         return []
     try:
-        pod_objs = v1api.list_namespaced_pod(ns).items
-        return [p.metadata.name for p in pod_objs if p.metadata and p.metadata.name]
+        return _get_pods(context_name, ns)
     except Exception as e:
         st.sidebar.error(f"Failed to list pods: {e}")
-        return []
+        return None
 
-pod_list = get_pods(v1_for_selected, namespace)
+# Only refetch when the cluster or namespace changed; reruns caused by other
+# widgets reuse the previous list. A failed listing is not remembered, so the
+# next rerun tries again
+pod_key = (selected_context, namespace)
+if st.session_state.get("last_pod_key") != pod_key:
+    pods = get_pods(selected_context, namespace)
+    if pods is None:
+        st.session_state.pod_list = []
+    else:
+        st.session_state.pod_list = pods
+        st.session_state.last_pod_key = pod_key
+
+pod_list = st.session_state.pod_list
 pod_options = ["-- Select a Pod --"] + pod_list
 selected_pod = st.sidebar.selectbox("📦 Pod", pod_options, index=0)
 st.sidebar.caption("Pick the pod you want to diagnose")
@@ -213,30 +465,74 @@ prompt = st.session_state.pending_input.strip()
 # Only allow diagnosis when cluster, namespace and pod are selected
 can_diagnose = (
     selected_context is not None
-    and namespace not in ("-- Select a Namespace --", "", None)
-    and prompt not in ("", None, "-- Select a Pod --")
+    and namespace not in _NS_SENTINELS
+    and prompt not in _POD_SENTINELS
 )
 
 if prompt and prompt != st.session_state.last_diagnosed_pod:
     st.session_state.diagnosis_result = None
+    st.session_state.evidence_md = None
     st.session_state.ai_chat = []
 
 
+# Diagnoses are shared across sessions for a short while, so toggling between
+# pods does not hit the API server again
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_diagnose(context_name, ns, pod_name):
+    v1api = _v1_for_context(context_name)
+    return diagnose_pod(v1api, pod_name, ns)
+
+
 # Run diagnostics
 if can_diagnose and st.session_state.last_diagnosed_pod != prompt and st.session_state.diagnosis_result is None:
 
     st.session_state.last_diagnosed_pod = prompt
 
     try:
-        result = diagnose_pod(v1_for_selected, prompt.strip(), namespace)
+        result = _cached_diagnose(selected_context, namespace, prompt.strip())
         st.session_state.diagnosis_result = result
+        st.session_state.evidence_md = None
     except Exception as e:
-        err_html = f"<p style='color:red;'>Error: {e}</p>"
+        err_html = f"<p style='color:red;'>Error: {escape(str(e))}</p>"
         st.error(f"Error: {e}")
-        st.session_state.messages.append({"role": "assistant", "content": err_html})
+        append_message("assistant", err_html)
         st.stop()
 
 
+# AI chat runs as a fragment: submitting a question reruns only this block,
+# not the sidebar listings and diagnosis cards above it
+@st.fragment
+def _ai_chat_fragment(diagnosis, cluster_context):
+    for chat in st.session_state.ai_chat:
+        with st.chat_message("user"):
+            st.markdown(chat["question"])
+        with st.chat_message("assistant"):
+            st.markdown(chat["answer"])
+
+    ai_user_message = st.chat_input(
+        "Ask me anything about this pod..."
+    )
+
+    if ai_user_message:
+        with st.chat_message("user"):
+            st.markdown(ai_user_message)
+
+        # Tokens are rendered as they arrive instead of after the full reply
+        with st.chat_message("assistant"):
+            ai_reply = st.write_stream(ask_groq_llm(
+                summary=diagnosis.get("summary"),
+                cause=diagnosis.get("likely_cause"),
+                recommendation=diagnosis.get("recommendation"),
+                cluster_context=cluster_context,
+                user_question=ai_user_message,
+            ))
+
+        st.session_state.ai_chat.append({
+            "question": ai_user_message,
+            "answer": ai_reply
+        })
+
+
 # Render UI ONLY IF we already have a diagnosis
 if st.session_state.diagnosis_result is not None:
     result = st.session_state.diagnosis_result
@@ -248,117 +544,32 @@ if st.session_state.diagnosis_result is not None:
 
         with st.spinner("Analyzing pod…"):
 
-            st.markdown(f"""
-            <div class="card">
-                <h3>Summary</h3>
-                <p>{result.get("summary", "")}</p>
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(_SUMMARY_TPL.format(escape(str(result.get("summary", "")))), unsafe_allow_html=True)
 
-            st.markdown(f"""
-            <div class="card">
-                <h3>Likely Cause</h3>
-                <p>{result.get("likely_cause", "")}</p>
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(_CAUSE_TPL.format(escape(str(result.get("likely_cause", "")))), unsafe_allow_html=True)
 
 
             # STRUCTURED EVIDENCE
             evidence = result.get("evidence", {})
 
             with st.expander("Evidence Details", expanded=True):
-
-                if isinstance(evidence, str):
-                    if "HTTP response body:" in evidence:
-                        st.markdown("### Kubernetes API Error")
-                        parsed = parse_k8s_api_error(evidence)
-
-                        excluded_keys = {"kind", "apiVersion", "metadata", "code"}
-
-                        for key, value in parsed.items():
-                            if key in excluded_keys:
-                                continue
-                            label = key.replace("_", " ").title()
-
-                            if isinstance(value, dict):
-                                if value:
-                                    st.markdown(f"**{label}:**")
-                                    st.code(json.dumps(value, indent=2))
-                            else:
-                                st.markdown(f"**{label}:** {value}")
-                    else:
-                        st.markdown("### Pod Description Analysis")
-                        st.code(evidence)
-
-                elif isinstance(evidence, list):
-                    st.markdown("**Logs / Events:**")
-                    st.code("\n".join([str(x) for x in evidence]))
-
-                elif isinstance(evidence, dict):
-                    for key, value in evidence.items():
-                        if key == "last_logs":
-                            continue
-                        label = key.replace("_", " ").title()
-
-                        if isinstance(value, list):
-                            st.markdown(f"**{label}:**")
-                            for item in value:
-                                st.markdown(f"- {item}")
-                        else:
-                            st.markdown(f"**{label}:** {value}")
-                else:
-                    st.write("No evidence available.")
+                # Built once per diagnosis, then reused on every rerun
+                if st.session_state.evidence_md is None:
+                    st.session_state.evidence_md = _render_evidence(evidence)
+                st.markdown(st.session_state.evidence_md)
 
 
             if isinstance(evidence, dict) and "last_logs" in evidence:
                 with st.expander("Latest Logs"):
                     st.code("\n".join(evidence["last_logs"]))
 
-            st.markdown(f"""
-            <div class="card" style="background-color:#1E3A8A; border-color:#3B82F6; color:#F3F4F6;">
-                <h3 style="color:#fff;">Recommendation</h3>
-                <p style="color:#E0E7FF;">{result.get("recommendation", "")}</p>
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(_RECOMMENDATION_TPL.format(escape(str(result.get("recommendation", "")))), unsafe_allow_html=True)
 
 
     # LLM integration code
-    for chat in st.session_state.ai_chat:
-        with st.chat_message("user"):
-            st.markdown(chat["question"])
-        with st.chat_message("assistant"):
-            st.markdown(chat["answer"])
-
-    ai_user_message = st.chat_input(
-        "Ask me anything about this pod..."
-    )
-
-    if ai_user_message:
-        with st.chat_message("user"):
-            st.markdown(ai_user_message)
-
-        # 🔹 Build cluster context for the LLM
-        cluster_context = {
-            "kube_context": selected_context,          # internal kube context name
-            "cluster_name": selected_cluster_display,  # nice label from dropdown
-            "namespace": namespace,
-            "pod_name": prompt
-        }
-
-        with st.spinner("AI is thinking..."):
-            ai_reply = ask_groq_llm(
-                summary=st.session_state.diagnosis_result.get("summary"),
-                cause=st.session_state.diagnosis_result.get("likely_cause"),
-                recommendation=st.session_state.diagnosis_result.get("recommendation"),
-                cluster_context=cluster_context,        # ✅ new argument
-                user_question=ai_user_message,
-            )
-
-        with st.chat_message("assistant"):
-            st.markdown(ai_reply)
-
-        st.session_state.ai_chat.append({
-            "question": ai_user_message,
-            "answer": ai_reply
-        })
-
+    _ai_chat_fragment(result, {
+        "kube_context": selected_context,          # internal kube context name
+        "cluster_name": selected_cluster_display,  # nice label from dropdown
+        "namespace": namespace,
+        "pod_name": prompt
+    })
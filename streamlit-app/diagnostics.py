@@ -1,51 +1,131 @@
-from kubernetes.client.rest import ApiException
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType, SimpleNamespace
 
-def diagnose_pod(v1, pod_name, namespace):
+from kubernetes.client.rest import ApiException
 
-    # Fetch Pod
-    try:
-        pod = v1.read_namespaced_pod(name=pod_name, namespace=namespace)
-    except ApiException as e:
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+# Keywords matched against the lowercased logs
+_DNS_NEEDLES = ("no such host", "temporary failure in name resolution", "nxdomain", "servfail")
+_PERM_NEEDLES = ("permission denied",)
+_TIMEOUT_NEEDLES = ("timeout",)
+_IGNORE_NEEDLES = (
+    "hnap1", "solr", "cgi-bin", "masscan", "nmap",
+    "paloaltonetworks", "odin", "favicon.ico", "go-http-client"
+)
+_APPERR_NEEDLES = ("error", "exception", "fatal", "panic")
+
+# Event reasons meaning the pod could not be scheduled or its volumes mounted
+_SCHED_REASONS = frozenset({"FailedScheduling", "FailedMount"})
+
+# Log keywords per diagnosis category
+_LOG_KEYWORDS = (
+    ("DNS", _DNS_NEEDLES),
+    ("PERM", _PERM_NEEDLES),
+    ("TIMEOUT", _TIMEOUT_NEEDLES),
+    ("SCANNER", _IGNORE_NEEDLES),
+    ("APPERR", _APPERR_NEEDLES),
+)
+
+# All keywords go into one Aho-Corasick automaton so the logs are scanned once
+if ahocorasick is not None:
+    _LOG_AUTOMATON = ahocorasick.Automaton()
+    for _category, _keywords in _LOG_KEYWORDS:
+        for _keyword in _keywords:
+            _LOG_AUTOMATON.add_word(_keyword, (_category, _keyword))
+    _LOG_AUTOMATON.make_automaton()
+
+
+# Returns the set of categories whose keywords appear in log_text
+def _scan_log_text(log_text):
+    # Pods that never started (or whose log read was skipped) have no logs
+    if not log_text:
+        return frozenset()
+    if ahocorasick is None:
         return {
-            "summary": f"Pod '{pod_name}' could not be found in the cluster.",
-            "likely_cause": "The pod name may be incorrect or it no longer exists in this namespace.",
-            "evidence": str(e),
-            "recommendation": "Double-check the pod name and selected namespace, then try again."
+            category for category, keywords in _LOG_KEYWORDS
+            if any(k in log_text for k in keywords)
         }
+    return {category for _, (category, _) in _LOG_AUTOMATON.iter(log_text)}
+
+
+# Last n log lines, split only when iterated (i.e. when the evidence is
+# rendered). Same lines as logs.splitlines()[-n:], but rsplit stops after the
+# tail instead of splitting the whole log. Pickles (protocol 2+) for
+# st.cache_data.
+class _LazyTail:
+    __slots__ = ("_text", "_n")
+
+    def __init__(self, text, n):
+        self._text = text
+        self._n = n
+
+    def __iter__(self):
+        pieces = self._text.rsplit("\n", self._n + 1)
+        tail = "\n".join(pieces[1:]) if len(pieces) > self._n + 1 else self._text
+        return iter(tail.splitlines()[-self._n:])
+
+    def __repr__(self):
+        return f"_LazyTail({list(self)!r})"
+
+
+def _pod_not_found(pod_name, e):
+    return {
+        "summary": f"Pod '{pod_name}' could not be found in the cluster.",
+        "likely_cause": "The pod name may be incorrect or it no longer exists in this namespace.",
+        "evidence": str(e),
+        "recommendation": "Double-check the pod name and selected namespace, then try again."
+    }
 
 
-    # Events
+# Events
+def _list_events(v1, pod_name, namespace):
     try:
-        events = v1.list_namespaced_event(
+        # resource_version="0" lets the apiserver answer from its watch cache
+        # instead of a quorum read from etcd. No limit: watch-cache lists
+        # ignore it, and the field selector already narrows to one pod
+        return v1.list_namespaced_event(
             namespace,
-            field_selector=f"involvedObject.name={pod_name}"
+            field_selector=f"involvedObject.name={pod_name}",
+            resource_version="0"
         ).items
     except Exception:
-        events = []
+        return []
 
-    event_messages = [f"{e.reason}: {e.message}" for e in events]
 
-
-    # Logs
+# Logs
+def _read_logs(v1, pod_name, namespace):
     try:
-        logs = v1.read_namespaced_pod_log(
+        # No limit_bytes: the kubelet applies it from the start of the tail,
+        # which would drop the newest lines the rules match on. The timeout
+        # keeps a slow kubelet from stalling the UI
+        return v1.read_namespaced_pod_log(
             name=pod_name,
             namespace=namespace,
-            tail_lines=50
+            tail_lines=50,
+            timestamps=False,
+            _request_timeout=(3, 10)
         )
     except Exception:
-        logs = ""
-
-    log_text = logs.lower() if isinstance(logs, str) else ""
+        return ""
 
 
-    # Status Info
-    phase = pod.status.phase
+# Status Info: current and last termination reason across the containers,
+# plus their total restart count, in a single pass
+def _container_reasons(container_statuses):
     reason = ""
     last_termination_reason = ""
-    container_statuses = pod.status.container_statuses or []
+    restart_count = 0
 
     for c in container_statuses:
+        restart_count += c.restart_count
+
         if c.state.waiting:
             reason = c.state.waiting.reason or ""
         elif c.state.terminated:
@@ -54,180 +134,307 @@ def diagnose_pod(v1, pod_name, namespace):
         if c.last_state and c.last_state.terminated:
             last_termination_reason = c.last_state.terminated.reason or ""
 
+    return reason, last_termination_reason, restart_count
+
 
-    restart_count = sum([c.restart_count for c in container_statuses])
+def _is_image_pull_failure(reason_l):
+    return "imagepullbackoff" in reason_l or "errimagepull" in reason_l
 
 
+# Logs are only worth fetching once a container has started (before that the
+# log endpoint has nothing to return) and when the image-pull rule, which
+# never looks at logs, does not already decide the diagnosis
+def _needs_logs(pod):
+    container_statuses = pod.status.container_statuses or []
+    reason, _, _ = _container_reasons(container_statuses)
+    if _is_image_pull_failure(reason.lower()):
+        return False
+    return any(
+        c.state.running or c.state.terminated or (c.last_state and c.last_state.terminated)
+        for c in container_statuses
+    )
+
+
+# Short-lived cache of (pod, events, logs) per client / namespace / pod, so
+# repeated diagnoses within a few seconds skip the API round-trips
+_BUNDLE_TTL = 5
+_BUNDLE_MAXSIZE = 256
+_bundle_cache = {}
+_bundle_lock = threading.Lock()
+
+
+def _fetch_pod_bundle(v1, pod_name, namespace):
+    key = (v1, namespace, pod_name)
+    now = time.monotonic()
+    with _bundle_lock:
+        hit = _bundle_cache.get(key)
+        if hit and now - hit[0] < _BUNDLE_TTL:
+            return hit[1]
+
+    # Raises ApiException for a missing pod; that is never cached
+    pod = v1.read_namespaced_pod(name=pod_name, namespace=namespace)
+
+    if _needs_logs(pod):
+        # Events and logs are independent, so read them concurrently; the
+        # client releases the GIL while waiting on the socket
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            f_events = ex.submit(_list_events, v1, pod_name, namespace)
+            f_logs = ex.submit(_read_logs, v1, pod_name, namespace)
+            bundle = (pod, f_events.result(), f_logs.result())
+    else:
+        bundle = (pod, _list_events(v1, pod_name, namespace), "")
+
+    with _bundle_lock:
+        _bundle_cache.pop(key, None)
+        if len(_bundle_cache) >= _BUNDLE_MAXSIZE:
+            # Entries are in insertion order, so this drops the oldest
+            del _bundle_cache[next(iter(_bundle_cache))]
+        _bundle_cache[key] = (now, bundle)
+    return bundle
+
+
+# v1 should be a long-lived CoreV1Api (the app keeps one per kubeconfig
+# context), so its connection pool is reused across diagnoses and the pod
+# bundle cache below can key on it
+def diagnose_pod(v1, pod_name, namespace):
+
+    # Fetch Pod, events and logs
+    try:
+        pod, events, logs = _fetch_pod_bundle(v1, pod_name, namespace)
+    except ApiException as e:
+        return _pod_not_found(pod_name, e)
+
+    return _analyze_pod(pod_name, pod, events, logs)
+
+
+# Events are classified by their short reason field; the "reason: message"
+# strings are only built for the evidence of the rule that matches
+def _event_messages(events):
+    return [f"{e.reason}: {e.message}" for e in events]
+
+
+def _is_probe_failure(event):
+    return event.reason == "Unhealthy" and "probe failed" in (event.message or "").lower()
+
+
+# Diagnosis rules in priority order, as (predicate, template, evidence).
+# Predicates and evidence builders take the context built in _analyze_pod;
+# the first rule whose predicate matches produces the result.
+RULES = (
     # IMAGE PULL FAILURE
-    if "imagepullbackoff" in reason.lower() or "errimagepull" in reason.lower():
-        return {
+    (
+        lambda c: _is_image_pull_failure(c.reason_l),
+        MappingProxyType({
             "summary": "The pod is unable to download the container image.",
             "likely_cause": "The specified image name or tag may not exist, or access to the registry is denied.",
-            "evidence": event_messages,
             "recommendation": (
                 "Verify the image name and tag in your Deployment file. "
                 "Also ensure the image exists and that Kubernetes has permission to pull it."
             )
-        }
-
+        }),
+        lambda c: _event_messages(c.events),
+    ),
 
     # SCHEDULING / VOLUME ISSUES
-    for e in event_messages:
-        if "FailedScheduling" in e or "FailedMount" in e:
-            return {
-                "summary": "The pod could not be scheduled or mounted correctly.",
-                "likely_cause": "There are insufficient node resources or an issue with volume/PVC attachment.",
-                "evidence": event_messages,
-                "recommendation": (
-                    "Check node CPU & memory availability, verify PersistentVolumeClaims, "
-                    "and ensure volume mounts are correctly configured."
-                )
-            }
-
+    (
+        lambda c: not _SCHED_REASONS.isdisjoint(c.event_reasons),
+        MappingProxyType({
+            "summary": "The pod could not be scheduled or mounted correctly.",
+            "likely_cause": "There are insufficient node resources or an issue with volume/PVC attachment.",
+            "recommendation": (
+                "Check node CPU & memory availability, verify PersistentVolumeClaims, "
+                "and ensure volume mounts are correctly configured."
+            )
+        }),
+        lambda c: _event_messages(c.events),
+    ),
 
     # DNS FAILURE
-    if any(k in log_text for k in [
-        "no such host", "temporary failure in name resolution", "nxdomain", "servfail"
-    ]):
-        return {
+    (
+        lambda c: "DNS" in c.hits,
+        MappingProxyType({
             "summary": "The pod is unable to resolve DNS hostnames.",
             "likely_cause": "Cluster DNS (CoreDNS) issue or incorrect service hostname being used.",
-            "evidence": logs.splitlines()[-15:],
             "recommendation": (
                 "Ensure CoreDNS pods are running and verify that the hostname or service name is correct. "
                 "Try running nslookup inside the pod to confirm DNS resolution."
             )
-        }
-
+        }),
+        lambda c: c.tail15,
+    ),
 
     # PERMISSION ERROR
-    if "permission denied" in log_text:
-        return {
+    (
+        lambda c: "PERM" in c.hits,
+        MappingProxyType({
             "summary": "The application failed due to file permission restrictions.",
             "likely_cause": "The container does not have sufficient permissions for required files or directories.",
-            "evidence": logs.splitlines()[-15:],
             "recommendation": (
                 "Adjust file permissions, container user settings, or volume access rights."
             )
-        }
-
+        }),
+        lambda c: c.tail15,
+    ),
 
     # NETWORK TIMEOUT
-    if "timeout" in log_text:
-        return {
+    (
+        lambda c: "TIMEOUT" in c.hits,
+        MappingProxyType({
             "summary": "The pod experienced network connectivity delays.",
             "likely_cause": "The application could not reach another service or external endpoint.",
-            "evidence": logs.splitlines()[-15:],
             "recommendation": (
                 "Verify target service availability, network policies, and DNS configuration."
             )
-        }
-
+        }),
+        lambda c: c.tail15,
+    ),
 
     # OOM KILL
-    if "oomkilled" in last_termination_reason.lower():
-        return {
+    (
+        lambda c: "oomkilled" in c.last_termination_reason_l,
+        MappingProxyType({
             "summary": "The pod was terminated due to excessive memory usage.",
             "likely_cause": "The application exceeded its assigned memory limit.",
-            "evidence": {
-                "restart_count": restart_count,
-                "logs": logs.splitlines()[-10:]
-            },
             "recommendation": (
                 "Increase memory limits or optimize the application's memory consumption."
             )
-        }
-
+        }),
+        lambda c: {
+            "restart_count": c.restart_count,
+            "logs": c.tail10
+        },
+    ),
 
     # PROBE FAILURE
-    probe_failures = [e for e in event_messages if "probe failed" in e.lower()]
-    if probe_failures:
-        return {
+    (
+        lambda c: any(_is_probe_failure(e) for e in c.events),
+        MappingProxyType({
             "summary": "Health checks are failing for this pod.",
             "likely_cause": "The pod is not responding properly to readiness or liveness probes.",
-            "evidence": probe_failures,
             "recommendation": (
                 "Ensure your health endpoints (/health or /ready) return HTTP 200 consistently."
             )
-        }
-
+        }),
+        lambda c: _event_messages(e for e in c.events if _is_probe_failure(e)),
+    ),
 
     # IGNORE SCANNER TRAFFIC
-    ignore_patterns = [
-        "hnap1", "solr", "cgi-bin", "masscan", "nmap",
-        "paloaltonetworks", "odin", "favicon.ico", "go-http-client"
-    ]
-
-    if any(p in log_text for p in ignore_patterns):
-        return {
+    (
+        lambda c: "SCANNER" in c.hits,
+        MappingProxyType({
             "summary": "Non-critical external scan traffic detected.",
             "likely_cause": "Automated internet scanners probing the exposed service.",
-            "evidence": logs.splitlines()[-10:],
             "recommendation": "This is normal behavior. No action is required."
-        }
-
+        }),
+        lambda c: c.tail10,
+    ),
 
     # APPLICATION ERRORS
-    if any(err in log_text for err in ["error", "exception", "fatal", "panic"]):
-        return {
+    (
+        lambda c: "APPERR" in c.hits,
+        MappingProxyType({
             "summary": "Application-level errors detected in logs.",
             "likely_cause": "Internal code or configuration issue in the application.",
-            "evidence": logs.splitlines()[-15:],
             "recommendation": (
                 "Review detailed logs and fix application-level issues."
             )
-        }
-
+        }),
+        lambda c: c.tail15,
+    ),
 
     # CRASH LOOP BACKOFF (LAST PRIORITY)
-    if "crashloopbackoff" in reason.lower():
-        backoff_events = [e for e in event_messages if "back-off" in e.lower() or "crash" in e.lower()]
-
-        return {
-            "summary": f"Pod '{pod_name}' is repeatedly crashing and restarting.",
+    (
+        lambda c: "crashloopbackoff" in c.reason_l,
+        MappingProxyType({
+            "summary": "Pod '{pod_name}' is repeatedly crashing and restarting.",
             "likely_cause": "The container process is failing during startup, causing Kubernetes to restart it continuously.",
-            "evidence": {
-                "restart_count": restart_count,
-                "state": "CrashLoopBackOff",
-                "relevant_events": backoff_events[:5],
-                "last_logs": logs.splitlines()[-10:]
-            },
             "recommendation": (
                 "Inspect application startup behavior and verify configuration, "
                 "environment variables, and required dependencies."
             ),
-        }
-
+        }),
+        lambda c: {
+            "restart_count": c.restart_count,
+            "state": "CrashLoopBackOff",
+            "relevant_events": [
+                e for e in _event_messages(c.events) if "back-off" in e.lower() or "crash" in e.lower()
+            ][:5],
+            "last_logs": c.tail10
+        },
+    ),
 
     # PENDING POD
-    if phase == "Pending":
-        return {
+    (
+        lambda c: c.phase == "Pending",
+        MappingProxyType({
             "summary": "The pod is waiting to be scheduled.",
             "likely_cause": "Insufficient node resources or scheduling conflicts.",
-            "evidence": event_messages,
             "recommendation": "Check node capacity and scaling configuration."
-        }
-
+        }),
+        lambda c: _event_messages(c.events),
+    ),
 
     # HEALTHY POD
-    if phase == "Running":
-        return {
+    (
+        lambda c: c.phase == "Running",
+        MappingProxyType({
             "summary": "The pod is healthy and running normally.",
             "likely_cause": "No operational issues detected.",
-            "evidence": logs.splitlines()[-10:],
             "recommendation": "No intervention required."
-        }
-
-
-    # UNKNOWN
-    return {
-        "summary": f"No clear failure pattern found for pod '{pod_name}'.",
+        }),
+        lambda c: c.tail10,
+    ),
+)
+
+# UNKNOWN: returned when no rule matches
+_UNKNOWN_RULE = (
+    MappingProxyType({
+        "summary": "No clear failure pattern found for pod '{pod_name}'.",
         "likely_cause": "The issue does not match any known diagnostic patterns.",
-        "evidence": {
-            "phase": phase,
-            "restart_count": restart_count,
-            "events": event_messages,
-            "logs": logs.splitlines()[-10:]
-        },
         "recommendation": "Inspect logs and describe output manually for deeper analysis."
-    }
+    }),
+    lambda c: {
+        "phase": c.phase,
+        "restart_count": c.restart_count,
+        "events": _event_messages(c.events),
+        "logs": c.tail10
+    },
+)
+
+
+def _build_result(template, evidence, c):
+    result = {**template, "evidence": evidence(c)}
+    result["summary"] = template["summary"].format(pod_name=c.pod_name)
+    return result
+
+
+def _analyze_pod(pod_name, pod, events, logs):
+
+    logs = logs if isinstance(logs, str) else ""
+    log_text = logs.lower()
+
+
+    # Status Info
+    container_statuses = pod.status.container_statuses or []
+    reason, last_termination_reason, restart_count = _container_reasons(container_statuses)
+
+
+    # Everything the rules look at, computed once
+    ctx = SimpleNamespace(
+        pod_name=pod_name,
+        phase=pod.status.phase,
+        reason_l=reason.lower(),
+        last_termination_reason_l=last_termination_reason.lower(),
+        restart_count=restart_count,
+        events=events,
+        event_reasons={e.reason for e in events},
+        tail15=_LazyTail(logs, 15),
+        tail10=_LazyTail(logs, 10),
+        hits=_scan_log_text(log_text),
+    )
+
+    for predicate, template, evidence in RULES:
+        if predicate(ctx):
+            return _build_result(template, evidence, ctx)
+
+    return _build_result(*_UNKNOWN_RULE, ctx)
@@ -1,61 +1,246 @@
+import asyncio
+import hashlib
+import json
 import os
-from groq import Groq
+import threading
+import time
+from functools import lru_cache
+
+import httpx
+from groq import AsyncGroq, DefaultAsyncHttpxClient, DefaultHttpxClient, Groq
 from dotenv import load_dotenv
 
-load_dotenv()
 
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# .env is read once, on the first question
+@lru_cache(maxsize=1)
+def _api_key():
+    load_dotenv()
+    return os.getenv("GROQ_API_KEY")
 
 
-def ask_groq_llm(summary, cause, recommendation, cluster_context, user_question):
+# Connection settings shared by the sync and async clients. Pooled HTTP/2
+# connections are kept alive between questions, so follow-ups skip the
+# TCP + TLS setup (the SDK default drops idle connections after 5s).
+# The SDK itself retries 429/5xx responses with exponential backoff.
+_HTTP_SETTINGS = {
+    "http2": True,
+    "limits": httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60),
+    "timeout": 30.0,
+}
+_MAX_RETRIES = 3
+
+
+# Built on first use and shared process-wide, so every question goes through
+# the same connection pool
+@lru_cache(maxsize=1)
+def _client():
+    return Groq(
+        api_key=_api_key(),
+        http_client=DefaultHttpxClient(**_HTTP_SETTINGS),
+        max_retries=_MAX_RETRIES,
+    )
+
+
+# Async client for concurrent questions. It is bound to the event loop it is
+# used on, so unlike _client() it is created per ask_groq_llm_many() call;
+# requests within that call share its HTTP/2 connection.
+def _async_client():
+    return AsyncGroq(
+        api_key=_api_key(),
+        http_client=DefaultAsyncHttpxClient(**_HTTP_SETTINGS),
+        max_retries=_MAX_RETRIES,
+    )
+
+
+# Recent answers keyed by a hash of the diagnosis, cluster context and
+# question, so a re-asked question is answered without another LLM call
+_ANSWER_TTL = 600
+_ANSWER_MAXSIZE = 512
+_answer_cache = {}
+_answer_lock = threading.Lock()
+
+
+def _answer_key(summary, cause, recommendation, cluster_context, user_question):
+    payload = json.dumps(
+        [summary, cause, recommendation, sorted(cluster_context.items()), user_question],
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
 
-    cluster_context = cluster_context or {}
+
+def _cached_answer(key):
+    with _answer_lock:
+        hit = _answer_cache.get(key)
+    if hit and time.monotonic() - hit[0] < _ANSWER_TTL:
+        return hit[1]
+    return None
+
+
+def _store_answer(key, answer):
+    with _answer_lock:
+        _answer_cache.pop(key, None)
+        if len(_answer_cache) >= _ANSWER_MAXSIZE:
+            # Entries are in insertion order, so this drops the oldest
+            del _answer_cache[next(iter(_answer_cache))]
+        _answer_cache[key] = (time.monotonic(), answer)
+
+
+# Fixed instructions sent with every question. Kept short and identical
+# across calls: prefill cost grows with prompt length, and a constant prefix
+# can be served from the provider's prompt cache. The word budget has to
+# fit the max_tokens=220 reply cap (about 165 words) so answers are not cut.
+_WORD_BUDGET = 150
+
+_SYSTEM_PREAMBLE = (
+    "You are a Kubernetes expert DevOps assistant helping a junior engineer. "
+    f"Keep each answer in markdown and at most {_WORD_BUDGET} words. "
+    "Reason only from the diagnosis given; you cannot run kubectl and must not "
+    "invent other root causes."
+)
+
+
+# Chat messages for one diagnosis; shared by the sync and async paths. The
+# per-pod data goes in the user message so the system prompt never changes.
+def _build_messages(summary, cause, recommendation, cluster_context, user_question):
 
     kube_context = cluster_context.get("kube_context", "Unknown")
     cluster_name = cluster_context.get("cluster_name", "Unknown")
     namespace = cluster_context.get("namespace", "Unknown")
     pod_name = cluster_context.get("pod_name", "Unknown")
 
-    cluster_block = f"""
-    Cluster Context:
-    - Kube context: {kube_context}
-    - Cluster name: {cluster_name}
-    - Namespace: {namespace}
-    - Pod: {pod_name}
-    """
+    user_content = (
+        f"Cluster: {cluster_name} (context {kube_context}), namespace {namespace}, pod {pod_name}\n"
+        f"Summary: {summary}\n"
+        f"Likely cause: {cause}\n"
+        f"Recommendation: {recommendation}\n\n"
+        f"Question: {user_question}"
+    )
 
-    system_prompt = f"""
-    You are a Kubernetes expert DevOps assistant.
+    return [
+        {"role": "system", "content": _SYSTEM_PREAMBLE},
+        {"role": "user", "content": user_content},
+    ]
 
-    Here is the diagnostic analysis:
 
-    Summary:
-    {summary}
+# Yields the answer as it is generated, for st.write_stream
+def ask_groq_llm(summary, cause, recommendation, cluster_context, user_question):
 
-    Likely Cause:
-    {cause}
+    cluster_context = cluster_context or {}
 
-    Recommendation:
-    {recommendation}
+    key = _answer_key(summary, cause, recommendation, cluster_context, user_question)
+    cached = _cached_answer(key)
+    if cached is not None:
+        yield cached
+        return
 
-    {cluster_block}
-    Rules:
-    - Explain clearly and simply, as if helping a junior DevOps engineer.
-    - Use the cluster / namespace / pod context when relevant.
-    - Do NOT assume you can run kubectl; only reason from the data provided.
-    - Keep answers concise (around 150–200 words) unless the user asks for deep detail.
-    - Do not invent new root causes beyond what the evidence supports.
-    - Return the answer in markdown format.
-    """
+    stream = _client().chat.completions.create(
+        model="llama-3.3-70b-versatile",
+        max_tokens=220,
+        temperature=0.3,
+        stop=["\n\n---"],
+        stream=True,
+        messages=_build_messages(summary, cause, recommendation, cluster_context, user_question),
+    )
 
-    response = client.chat.completions.create(
+    parts = []
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    # Only a fully received answer is cached
+    _store_answer(key, "".join(parts))
+
+
+async def ask_groq_llm_async(aclient, summary, cause, recommendation, cluster_context, user_question):
+
+    cluster_context = cluster_context or {}
+
+    key = _answer_key(summary, cause, recommendation, cluster_context, user_question)
+    cached = _cached_answer(key)
+    if cached is not None:
+        return cached
+
+    response = await aclient.chat.completions.create(
         model="llama-3.3-70b-versatile",
-        max_tokens=250,
+        max_tokens=220,
         temperature=0.3,
+        stop=["\n\n---"],
+        messages=_build_messages(summary, cause, recommendation, cluster_context, user_question),
+    )
+
+    answer = response.choices[0].message.content.strip()
+    _store_answer(key, answer)
+    return answer
+
+
+# Answer several questions concurrently instead of one after another. Each
+# request is a dict of ask_groq_llm keyword arguments; answers come back in
+# the same order.
+def ask_groq_llm_many(requests):
+    return asyncio.run(_ask_groq_llm_many(requests))
+
+
+async def _ask_groq_llm_many(requests):
+    async with _async_client() as aclient:
+        return list(await asyncio.gather(
+            *(ask_groq_llm_async(aclient, **r) for r in requests)
+        ))
+
+
+# Pods per batched request; keeps the prompt and the JSON reply manageable
+_BATCH_SIZE = 10
+
+
+# Answer the same question for several pods with one request per batch
+# instead of one per pod. Each diagnosis is a diagnose_pod() result,
+# optionally with "pod_name" / "namespace" added. Returns one answer per
+# diagnosis, in order ("" if the model skipped a pod).
+def ask_groq_llm_batch(diagnoses, user_question):
+
+    answers = []
+    for start in range(0, len(diagnoses), _BATCH_SIZE):
+        answers.extend(_ask_groq_llm_batch(diagnoses[start:start + _BATCH_SIZE], user_question))
+    return answers
+
+
+def _ask_groq_llm_batch(diagnoses, user_question):
+
+    pod_blocks = []
+    for i, d in enumerate(diagnoses, start=1):
+        pod_blocks.append(
+            f"### Pod {i}\n"
+            f"Name: {d.get('pod_name', 'Unknown')}, namespace {d.get('namespace', 'Unknown')}\n"
+            f"Summary: {d.get('summary')}\n"
+            f"Likely cause: {d.get('likely_cause')}\n"
+            f"Recommendation: {d.get('recommendation')}\n"
+        )
+
+    system_prompt = (
+        _SYSTEM_PREAMBLE
+        + " Answer the question separately for every pod and reply"
+        ' with JSON only: {"answers": [{"pod": 1, "answer": "..."}, ...]}'
+    )
+
+    response = _client().chat.completions.create(
+        model="llama-3.3-70b-versatile",
+        max_tokens=250 * len(diagnoses),
+        temperature=0.3,
+        response_format={"type": "json_object"},
         messages=[
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_question},
+            {"role": "user", "content": "\n".join(pod_blocks) + f"\nQuestion: {user_question}"},
         ],
     )
 
-    return response.choices[0].message.content.strip()
+    by_pod = {}
+    for item in json.loads(response.choices[0].message.content).get("answers", []):
+        if not isinstance(item, dict):
+            continue
+        try:
+            by_pod[int(item.get("pod"))] = str(item.get("answer", "")).strip()
+        except (TypeError, ValueError):
+            continue
+
+    return [by_pod.get(i, "") for i in range(1, len(diagnoses) + 1)]